@@ -6,6 +6,7 @@ import logging
 from aiohttp import web
 
 from app.main import create_app
+from app.partitioning import partition_client_table
 from app.unholder import periodic_unhold_all
 
 
@@ -15,6 +16,7 @@ logging.basicConfig(level=logging.INFO)
 class Mode(enum.Enum):
     SERVER = "server"
     UNHOLDER = "unholder"
+    PARTITION = "partition"
 
     def __str__(self):
         return self.value
@@ -30,6 +32,8 @@ def main() -> None:
         web.run_app(create_app(), port=80)
     elif args.mode == Mode.UNHOLDER:
         asyncio.run(periodic_unhold_all())
+    elif args.mode == Mode.PARTITION:
+        asyncio.run(partition_client_table())
     else:
         raise NotImplementedError
 
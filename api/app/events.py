@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from typing import Optional, Tuple
+
+import asyncpg
+
+from app.queries import query_events_head
+
+
+class EventNotifier:
+    """Будит запросы, ждущие новых событий, когда лента продвигается.
+
+    Один фоновый цикл на процесс раз в `interval` секунд проверяет позицию
+    последнего события в ленте, и ожидающие запросы перечитывают ленту, только
+    когда она изменилась. Пока никто не ждёт, база не опрашивается.
+
+    Соединение для проверки каждый раз берётся из пула, а ошибка проверки только
+    логируется, поэтому после перезапуска PostgreSQL или обрыва связи проверки
+    продолжаются, как только база снова доступна.
+    """
+
+    def __init__(
+        self, pool: asyncpg.pool.Pool, interval: float, timeout: float
+    ) -> None:
+        self.pool = pool
+        self.interval = interval
+        self.timeout = timeout
+        self._head: Optional[Tuple[int, int]] = None
+        self._wakeup = asyncio.Event()
+        self._waiting = 0
+        self._task: Optional[asyncio.Future] = None
+
+    def start(self) -> None:
+        """Запустить фоновые проверки ленты."""
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self) -> None:
+        """Остановить фоновые проверки ленты."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def notify(self) -> None:
+        """Разбудить всех, кто ждёт новых событий."""
+        wakeup, self._wakeup = self._wakeup, asyncio.Event()
+        wakeup.set()
+
+    def waiter(self) -> asyncio.Event:
+        """Событие, которое выставится при следующем продвижении ленты.
+
+        Его нужно получить до чтения ленты, чтобы не пропустить события,
+        появившиеся между чтением и ожиданием.
+        """
+        return self._wakeup
+
+    async def wait(self, wakeup: asyncio.Event, timeout: float) -> bool:
+        """Ждать `wakeup` не дольше `timeout` секунд.
+
+        :param wakeup: событие, полученное из `waiter`
+        :param timeout: сколько секунд ждать
+        :returns: `True`, если лента продвинулась, и `False` по таймауту
+        """
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiting -= 1
+
+    async def check(self) -> None:
+        """Проверить позицию ленты и разбудить ожидающих, если она изменилась."""
+        async with self.pool.acquire(timeout=self.timeout) as connection:
+            head = await query_events_head(connection, self.timeout)
+        # пока никто не ждал, позиция не проверялась и могла устареть, поэтому
+        # её изменение будит всегда: лишнее перечитывание ленты безопасно
+        if head != self._head:
+            self._head = head
+            self.notify()
+
+    async def _run(self) -> None:
+        while True:
+            if self._waiting:
+                try:
+                    await self.check()
+                except Exception:
+                    # цикл не должен остановиться, иначе ожидающие будут спать
+                    # до таймаута, пока не перезапустят API
+                    logging.exception("Could not check the event feed")
+            await asyncio.sleep(self.interval)
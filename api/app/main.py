@@ -1,4 +1,5 @@
-from typing import Any, List, Callable, Mapping, Optional
+from typing import Any, List, Callable, Mapping, Optional, Tuple
+import asyncio
 import sys
 import random
 import functools
@@ -10,7 +11,16 @@ import asyncpg
 from aiohttp import web
 
 from app.settings import Settings
-from app.queries import query_add, query_subtract, query_status, NotEnoughMoneyError
+from app.queries import (
+    query_add,
+    query_subtract,
+    query_status,
+    query_events,
+    query_wal_lsn,
+    NotEnoughMoneyError,
+)
+from app.events import EventNotifier
+from app.replicas import Replica, ReplicaRouter, periodic_refresh
 
 
 def json_response(
@@ -52,13 +62,61 @@ async def startup(app: web.Application) -> None:
     app["pg"] = await asyncpg.create_pool(
         dsn=settings.pg_dsn, min_size=2, init=init_connection
     )
+    app["events"] = EventNotifier(
+        app["pg"], settings.events_check_interval, settings.events_check_timeout
+    )
+    app["events"].start()
+
+    # соединения к репликам открываются лениво, чтобы недоступная реплика
+    # не мешала запуску API
+    replicas = [
+        Replica(
+            dsn,
+            await asyncpg.create_pool(dsn=dsn, min_size=0, init=init_connection),
+        )
+        for dsn in settings.replica_dsns
+    ]
+    app["replicas"] = ReplicaRouter(
+        app["pg"],
+        replicas,
+        max_lag=settings.replica_max_lag,
+        max_tracked_writes=settings.replica_max_tracked_writes,
+        query_timeout=settings.replica_query_timeout,
+    )
+    if replicas:
+        # записи, сделанные до перезапуска, неизвестны, поэтому читать с реплики
+        # можно только после того, как она догонит текущую позицию мастера
+        async with app["pg"].acquire() as connection:
+            app["replicas"].require_for_all(await query_wal_lsn(connection))
+        app["replicas_refresher"] = asyncio.ensure_future(
+            periodic_refresh(app["replicas"], settings.replica_check_interval)
+        )
 
 
 async def cleanup(app: web.Application):
     """Завершение работы приложения."""
+    if "replicas_refresher" in app:
+        app["replicas_refresher"].cancel()
+    for replica in app["replicas"].replicas:
+        await replica.pool.close()
+    await app["events"].close()
     await app["pg"].close()
 
 
+async def remember_write(
+    request: web.Request, connection: asyncpg.Connection, uuid: str
+) -> None:
+    """Запомнить позицию журнала после записи, чтобы не читать счёт с отставших реплик.
+
+    :param request: запрос
+    :param connection: соединение к мастеру, через которое прошла запись
+    :param uuid: идентификатор клиента
+    """
+    router: ReplicaRouter = request.app["replicas"]
+    if router.replicas:
+        await router.track_write(uuid, connection)
+
+
 async def ping(request: web.Request) -> web.Response:
     answers: List[str] = [
         "I'm ok!",
@@ -86,6 +144,7 @@ async def add(request: web.Request, uuid: str, how_much: int) -> web.Response:
         row = await query_add(connection, uuid, how_much)
         if not row:
             raise web.HTTPNotFound()
+        await remember_write(request, connection, uuid)
         return json_response(dict(row.items()))
 
 
@@ -104,16 +163,81 @@ async def subtract(request: web.Request, uuid: str, how_much: int) -> web.Respon
 
         if not row:
             raise web.HTTPNotFound()
+        await remember_write(request, connection, uuid)
         return json_response(dict(row.items()))
 
 
 async def status(request: web.Request, uuid: str) -> web.Response:
-    """Получить данные о текущем состоянии счёта клиента."""
-    async with request.app["pg"].acquire() as connection:
-        row: Optional[asyncpg.Record] = await query_status(connection, uuid)
-        if not row:
-            raise web.HTTPNotFound()
-        return json_response(dict(row.items()))
+    """Получить данные о текущем состоянии счёта клиента.
+
+    Чтение идёт с реплики, если она не отстала от последней записи клиента;
+    если реплика недоступна или не ответила вовремя, то запрос повторяется на мастере.
+    """
+    router: ReplicaRouter = request.app["replicas"]
+    row: Optional[asyncpg.Record] = await router.read(
+        uuid, lambda connection, timeout: query_status(connection, uuid, timeout)
+    )
+    if not row:
+        raise web.HTTPNotFound()
+    return json_response(dict(row.items()))
+
+
+def _parse_offset(offset: str) -> Tuple[int, int]:
+    """Разобрать позицию в ленте событий вида `<tx_id>-<id>`.
+
+    Пустая строка означает начало ленты.
+
+    :raises ValueError: если позиция в неверном формате
+    """
+    if not offset:
+        return 0, 0
+    tx_id, _, event_id = offset.partition("-")
+    return int(tx_id), int(event_id)
+
+
+async def events(request: web.Request, offset: str, limit: int) -> web.Response:
+    """Получить пачку событий изменения балансов, следующих за `offset`.
+
+    Если новых событий нет, то запрос ждёт их появления до `events_poll_timeout`
+    секунд; лента перечитывается, только когда в ней появляются новые события.
+    Чтобы продолжить чтение, нужно передать `next_offset` из ответа.
+
+    :param request: запрос
+    :param offset: позиция последнего прочитанного события; пустая строка -- начало
+    :param limit: максимальное количество событий в ответе
+    """
+    settings: Settings = request.app["settings"]
+    try:
+        after_tx_id, after_id = _parse_offset(offset)
+    except ValueError:
+        raise web.HTTPBadRequest(reason="Invalid offset")
+    limit = max(1, min(limit, settings.events_max_batch))
+
+    notifier: EventNotifier = request.app["events"]
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + settings.events_poll_timeout
+    while True:
+        wakeup = notifier.waiter()
+        # соединение не держим, пока ждём новых событий
+        async with request.app["pg"].acquire() as connection:
+            rows = await query_events(connection, after_tx_id, after_id, limit)
+        remaining = deadline - loop.time()
+        if rows or remaining <= 0:
+            break
+        if not await notifier.wait(wakeup, remaining):
+            break
+
+    if rows:
+        offset = f"{rows[-1]['tx_id']}-{rows[-1]['id']}"
+    return json_response(
+        {
+            "events": [
+                dict(row.items(), created_at=row["created_at"].isoformat())
+                for row in rows
+            ],
+            "next_offset": offset,
+        }
+    )
 
 
 def _check_args(handler: Callable, args: Mapping[str, Any]) -> List[str]:
@@ -208,4 +332,5 @@ async def create_app(settings: Settings = Settings()) -> web.Application:
     app.router.add_post("/api/add", add, name="add")  # type: ignore
     app.router.add_post("/api/subtract", subtract, name="subtract")  # type: ignore
     app.router.add_post("/api/status", status, name="status")  # type: ignore
+    app.router.add_post("/api/events", events, name="events")  # type: ignore
     return app
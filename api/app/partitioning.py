@@ -0,0 +1,279 @@
+import asyncio
+import logging
+from typing import Optional
+
+import asyncpg
+
+from app.settings import Settings
+
+# начиная с этой версии `UPDATE` отсекает секции и в обобщённых планах
+MIN_SERVER_VERSION = 14
+FIRST_ID = "00000000-0000-0000-0000-000000000000"
+
+
+class PartitioningNotSupportedError(Exception):
+    """Ошибка, возникающая, если PostgreSQL не умеет отсекать секции в `UPDATE`."""
+
+
+class PartitionCountMismatchError(Exception):
+    """Ошибка, возникающая, если `client_new` прерванной миграции секционирована иначе."""
+
+
+async def create_partitioned_table(
+    connection: asyncpg.Connection, table: str, partitions: int
+) -> None:
+    """Создать таблицу клиентов, секционированную по хэшу `id`.
+
+    Секции называются `<table>_p<номер>`. Если таблица уже есть, то ничего не
+    происходит, так что миграцию можно перезапустить после сбоя.
+
+    :param connection: соединение
+    :param table: имя таблицы
+    :param partitions: количество секций
+    """
+    async with connection.transaction():
+        await connection.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                   id UUID PRIMARY KEY,
+                   name TEXT NOT NULL,
+                   balance BIGINT NOT NULL,
+                   hold BIGINT NOT NULL,
+                   is_open BOOLEAN DEFAULT TRUE
+            ) PARTITION BY HASH (id)
+            """
+        )
+        for remainder in range(partitions):
+            await connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table}_p{remainder}
+                PARTITION OF {table}
+                FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})
+                """
+            )
+
+
+async def _install_sync_trigger(connection: asyncpg.Connection) -> None:
+    """Повесить на `client` триггер, дублирующий изменения в `client_new`.
+
+    Пока строки копируются пачками, API продолжает писать в старую таблицу;
+    триггер гарантирует, что эти изменения не потеряются.
+    """
+    async with connection.transaction():
+        await connection.execute(
+            """
+            CREATE OR REPLACE FUNCTION client_sync_to_new() RETURNS TRIGGER AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    DELETE FROM client_new WHERE id = OLD.id;
+                    RETURN OLD;
+                END IF;
+                IF TG_OP = 'UPDATE' AND NEW.id <> OLD.id THEN
+                    DELETE FROM client_new WHERE id = OLD.id;
+                END IF;
+                INSERT INTO client_new
+                       (id, name, balance, hold, is_open)
+                VALUES
+                       (NEW.id, NEW.name, NEW.balance, NEW.hold, NEW.is_open)
+                ON CONFLICT (id) DO UPDATE SET
+                       name = EXCLUDED.name,
+                       balance = EXCLUDED.balance,
+                       hold = EXCLUDED.hold,
+                       is_open = EXCLUDED.is_open;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+            """
+        )
+        await connection.execute("DROP TRIGGER IF EXISTS client_sync ON client")
+        await connection.execute(
+            """
+            CREATE TRIGGER client_sync
+            AFTER INSERT OR UPDATE OR DELETE ON client
+            FOR EACH ROW EXECUTE PROCEDURE client_sync_to_new()
+            """
+        )
+
+
+async def _copy_batch(
+    connection: asyncpg.Connection, after_id: str, batch_size: int
+) -> Optional[str]:
+    """Скопировать из `client` в `client_new` пачку строк, следующих за `after_id`.
+
+    Пачка -- отдельная короткая транзакция. Скопированные строки блокируются
+    `FOR SHARE`, поэтому параллельное изменение строки либо дождётся копирования и
+    будет продублировано триггером, либо успеет раньше и попадёт в пачку уже в
+    новом виде.
+
+    :returns: `id` последней скопированной строки или `None`, если строк больше нет
+    """
+    async with connection.transaction():
+        last_id: Optional[str] = await connection.fetchval(
+            """
+            WITH batch AS (
+                SELECT
+                    id, name, balance, hold, is_open
+                FROM
+                    client
+                WHERE
+                    id > $1
+                ORDER BY
+                    id
+                LIMIT $2
+                FOR SHARE
+            ), inserted AS (
+                INSERT INTO client_new
+                       (id, name, balance, hold, is_open)
+                SELECT
+                       id, name, balance, hold, is_open
+                FROM
+                       batch
+                ON CONFLICT (id) DO NOTHING
+            )
+            SELECT id FROM batch ORDER BY id DESC LIMIT 1
+            """,
+            after_id,
+            batch_size,
+        )
+    return last_id
+
+
+async def _copy_batches(connection: asyncpg.Connection, batch_size: int) -> None:
+    """Скопировать все строки из `client` в `client_new` пачками по `id`."""
+    last_id: Optional[str] = FIRST_ID
+    batches = 0
+    while last_id is not None:
+        last_id = await _copy_batch(connection, last_id, batch_size)
+        batches += 1
+        logging.info(f"Copied {batches} batches...")
+
+
+async def _swap_tables(
+    connection: asyncpg.Connection,
+    partitions: int,
+    lock_timeout: float,
+    attempts: int,
+) -> None:
+    """Подменить `client` секционированной таблицей одной короткой транзакцией.
+
+    Блокировка `client` ждёт не дольше `lock_timeout` секунд: пока транзакция
+    ждёт её, все запросы API к `client` стоят в очереди за ней. Если дождаться не
+    удалось (например, идёт снятие холдов), то попытка повторяется.
+
+    Индексы первичных ключей переименовываются вместе с таблицами, чтобы имена
+    `client_new*` освободились для следующей миграции. Старая таблица остаётся
+    под именем `client_old`, удалить её нужно вручную после проверки.
+
+    :raises asyncpg.exceptions.LockNotAvailableError: если все попытки неудачны
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            async with connection.transaction():
+                await connection.execute(
+                    f"SET LOCAL lock_timeout = {int(lock_timeout * 1000)}"
+                )
+                await connection.execute("LOCK TABLE client IN ACCESS EXCLUSIVE MODE")
+                await connection.execute("DROP TRIGGER client_sync ON client")
+                await connection.execute("DROP FUNCTION client_sync_to_new()")
+                await connection.execute("ALTER TABLE client RENAME TO client_old")
+                await connection.execute(
+                    "ALTER INDEX client_pkey RENAME TO client_old_pkey"
+                )
+                await connection.execute("ALTER TABLE client_new RENAME TO client")
+                await connection.execute(
+                    "ALTER INDEX client_new_pkey RENAME TO client_pkey"
+                )
+                for remainder in range(partitions):
+                    await connection.execute(
+                        f"ALTER TABLE client_new_p{remainder} "
+                        f"RENAME TO client_p{remainder}"
+                    )
+                    await connection.execute(
+                        f"ALTER INDEX client_new_p{remainder}_pkey "
+                        f"RENAME TO client_p{remainder}_pkey"
+                    )
+            return
+        except asyncpg.exceptions.LockNotAvailableError:
+            logging.warning(f"Could not lock `client` (attempt {attempt}/{attempts})")
+            if attempt == attempts:
+                raise
+            await asyncio.sleep(lock_timeout)
+
+
+async def migrate_client_table(
+    connection: asyncpg.Connection,
+    partitions: int,
+    batch_size: int,
+    lock_timeout: float = 1.0,
+    swap_attempts: int = 10,
+) -> None:
+    """Перенести таблицу `client` в секционированную по хэшу без остановки API.
+
+    Нужен PostgreSQL 14 или новее: в более старых версиях `UPDATE` по `id` не
+    отсекает лишние секции, и запросы API обходили бы индексы всех секций.
+
+    :param connection: соединение
+    :param partitions: количество секций
+    :param batch_size: количество строк, копируемых одной транзакцией
+    :param lock_timeout: сколько секунд ждать блокировку при подмене таблиц
+    :param swap_attempts: сколько раз пытаться подменить таблицы
+    :raises PartitioningNotSupportedError: если версия PostgreSQL слишком старая
+    :raises PartitionCountMismatchError: если после сбоя осталась `client_new` с
+        другим количеством секций
+    """
+    server_version = connection.get_server_version()
+    if server_version.major < MIN_SERVER_VERSION:
+        raise PartitioningNotSupportedError(
+            f"PostgreSQL {MIN_SERVER_VERSION}+ is required, "
+            f"got {server_version.major}"
+        )
+
+    is_partitioned = await connection.fetchval(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = 'client'::regclass"
+    )
+    if is_partitioned:
+        logging.info("Table `client` is already partitioned, nothing to do")
+        return
+
+    # после сбоя `client_new` уже может быть, и её секции должны совпадать
+    existing_partitions = await connection.fetchval(
+        """
+        SELECT
+            count(*)
+        FROM
+            pg_inherits
+        WHERE
+            inhparent = to_regclass('client_new')
+        """
+    )
+    if existing_partitions and existing_partitions != partitions:
+        raise PartitionCountMismatchError(
+            f"Table `client_new` from an interrupted migration has "
+            f"{existing_partitions} partitions, but {partitions} are requested; "
+            f"rerun with {existing_partitions} partitions or drop `client_new`"
+        )
+
+    logging.info(f"Creating `client_new` with {partitions} partitions...")
+    await create_partitioned_table(connection, "client_new", partitions)
+    await _install_sync_trigger(connection)
+    await _copy_batches(connection, batch_size)
+    logging.info("Swapping tables...")
+    await _swap_tables(connection, partitions, lock_timeout, swap_attempts)
+    await connection.execute("ANALYZE client")
+    logging.info("Done; old table is kept as `client_old`")
+
+
+async def partition_client_table() -> None:
+    """Секционировать `client` с параметрами из настроек."""
+    settings = Settings()
+    connection = await asyncpg.connect(dsn=settings.pg_dsn)
+    try:
+        await migrate_client_table(
+            connection,
+            settings.client_partitions,
+            settings.partition_batch_size,
+            settings.partition_swap_lock_timeout,
+            settings.partition_swap_attempts,
+        )
+    finally:
+        await connection.close()
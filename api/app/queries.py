@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import asyncpg
 
@@ -12,6 +12,8 @@ async def query_add(
 ) -> Optional[asyncpg.Record]:
     """Запрос для пополнения счёта клинта.
 
+    Изменение баланса записывается в `client_event` в той же транзакции.
+
     :param connection: соединение
     :param uuid: идентификатор клиента
     :param how_much: количество копеек, которые нужно прибавить на баланс клиента
@@ -19,14 +21,26 @@ async def query_add(
     async with connection.transaction():
         row = await connection.fetchrow(
             """
-            UPDATE
-                client
-            SET
-                balance = balance + GREATEST(0, $2)
-            WHERE
-                id = $1 AND
-                is_open = TRUE
-            RETURNING *
+            WITH updated AS (
+                UPDATE
+                    client
+                SET
+                    balance = balance + GREATEST(0, $2)
+                WHERE
+                    id = $1 AND
+                    is_open = TRUE
+                RETURNING *
+            ), event AS (
+                INSERT INTO client_event
+                       (client_id, kind, amount, balance, hold)
+                SELECT
+                       id, 'add', $2, balance, hold
+                FROM
+                       updated
+                WHERE
+                       $2 > 0
+            )
+            SELECT * FROM updated
             """,
             uuid,
             how_much,
@@ -39,6 +53,9 @@ async def query_subtract(
 ) -> Optional[asyncpg.Record]:
     """Запрос на снятие указанной суммы со счёта клиента.
 
+    Изменение холда записывается в `client_event` в той же транзакции; если денег
+    не хватило, то транзакция откатывается вместе с событием.
+
     :param connection: соединение
     :param uuid: идентификатор клиента
     :param how_much: количество копеек, которые нужно снять с баланса клиента
@@ -47,14 +64,26 @@ async def query_subtract(
     async with connection.transaction():
         row: Optional[asyncpg.Record] = await connection.fetchrow(
             """
-            UPDATE
-                client
-            SET
-                hold = hold + GREATEST(0, $2)
-            WHERE
-                id = $1 AND
-                is_open = TRUE
-            RETURNING *
+            WITH updated AS (
+                UPDATE
+                    client
+                SET
+                    hold = hold + GREATEST(0, $2)
+                WHERE
+                    id = $1 AND
+                    is_open = TRUE
+                RETURNING *
+            ), event AS (
+                INSERT INTO client_event
+                       (client_id, kind, amount, balance, hold)
+                SELECT
+                       id, 'subtract', $2, balance, hold
+                FROM
+                       updated
+                WHERE
+                       $2 > 0
+            )
+            SELECT * FROM updated
             """,
             uuid,
             how_much,
@@ -65,34 +94,235 @@ async def query_subtract(
 
 
 async def query_status(
-    connection: asyncpg.Connection, uuid: str
+    connection: asyncpg.Connection, uuid: str, timeout: Optional[float] = None
 ) -> Optional[asyncpg.Record]:
     """Запрос для получения текущего состояния счёта клиента.
 
     :param connection: соединение
     :param uuid: идентификатор клиента
+    :param timeout: сколько секунд ждать ответа
     """
     row: Optional[asyncpg.Record] = await connection.fetchrow(
         """
         SELECT * FROM client WHERE id = $1
         """,
         uuid,
+        timeout=timeout,
     )
     return row
 
 
+async def query_wal_lsn(
+    connection: asyncpg.Connection, timeout: Optional[float] = None
+) -> int:
+    """Запрос текущей позиции в журнале предзаписи на мастере.
+
+    Вызванный после коммита, запрос возвращает позицию не меньше позиции этого
+    коммита, поэтому реплика, проигравшая журнал до неё, уже видит изменения.
+
+    :param connection: соединение к мастеру
+    :param timeout: сколько секунд ждать ответа
+    :returns: позиция в журнале в байтах
+    """
+    lsn: int = await connection.fetchval(
+        """
+        SELECT (pg_current_wal_insert_lsn() - '0/0')::bigint
+        """,
+        timeout=timeout,
+    )
+    return lsn
+
+
+async def query_replay_lsn(
+    connection: asyncpg.Connection, timeout: Optional[float] = None
+) -> int:
+    """Запрос позиции в журнале, до которой реплика проиграла изменения.
+
+    Отставание по этой позиции нужно считать относительно мастера: если реплика
+    потеряла связь с мастером, то сама она не знает, насколько отстала.
+
+    :param connection: соединение к реплике
+    :param timeout: сколько секунд ждать ответа
+    :returns: позиция в журнале в байтах
+    """
+    lsn: int = await connection.fetchval(
+        """
+        SELECT
+            CASE
+                WHEN pg_is_in_recovery()
+                THEN (pg_last_wal_replay_lsn() - '0/0')::bigint
+                ELSE (pg_current_wal_insert_lsn() - '0/0')::bigint
+            END
+        """,
+        timeout=timeout,
+    )
+    return lsn
+
+
+async def query_client_partitions(connection: asyncpg.Connection) -> List[str]:
+    """Запрос списка таблиц, в которых физически лежат строки `client`.
+
+    Если таблица `client` секционирована, то возвращаются имена её секций,
+    иначе -- только сама таблица `client`.
+
+    :param connection: соединение
+    """
+    rows = await connection.fetch(
+        """
+        SELECT
+            inhrelid::regclass::text AS name
+        FROM
+            pg_inherits
+        WHERE
+            inhparent = 'client'::regclass
+        ORDER BY
+            name
+        """
+    )
+    return [row["name"] for row in rows] or ["client"]
+
+
 async def query_unhold_all(connection: asyncpg.Connection) -> None:
     """Запрос для обновления баланса и обнуления холда у всех клиентов.
 
+    Каждая секция таблицы `client` обрабатывается в отдельной транзакции,
+    поэтому блокировки и мёртвые версии строк не копятся по всей таблице сразу.
+    Строки без холда не трогаются. Для каждого клиента, у которого был снят холд,
+    в `client_event` записывается событие.
+
     :param connection: соединение
     """
-    async with connection.transaction():
-        await connection.execute(
-            """
-            UPDATE
-                client
-            SET
-                balance = balance - hold,
-                hold = 0
+    for table in await query_client_partitions(connection):
+        async with connection.transaction():
+            await connection.execute(
+                f"""
+                WITH settled AS (
+                    UPDATE
+                        {table} AS client
+                    SET
+                        balance = client.balance - client.hold,
+                        hold = 0
+                    FROM (
+                        SELECT id, hold FROM {table} WHERE hold <> 0 FOR UPDATE
+                    ) AS held
+                    WHERE
+                        client.id = held.id
+                    RETURNING client.id, held.hold AS amount, client.balance
+                )
+                INSERT INTO client_event
+                       (client_id, kind, amount, balance, hold)
+                SELECT
+                       id, 'unhold', amount, balance, 0
+                FROM
+                       settled
+                """
+            )
+
+
+async def query_events(
+    connection: asyncpg.Connection, after_tx_id: int, after_id: int, limit: int
+) -> List[asyncpg.Record]:
+    """Запрос пачки событий из `client_event`, следующих за указанной позицией.
+
+    События упорядочены по транзакции, а затем по `id`. Отдаются только события
+    транзакций старше самой старой ещё не завершённой, поэтому более ранние
+    события не могут появиться после того, как потребитель прочитал более поздние.
+
+    Эта граница общая для всего кластера PostgreSQL: пока открыта любая пишущая
+    транзакция в любой базе (миграция, бенчмарк, сессия `idle in transaction`),
+    лента не отдаёт события, записанные после её начала.
+
+    :param connection: соединение
+    :param after_tx_id: транзакция последнего прочитанного события
+    :param after_id: идентификатор последнего прочитанного события
+    :param limit: максимальное количество событий
+    """
+    rows: List[asyncpg.Record] = await connection.fetch(
+        """
+        SELECT
+            id, tx_id, client_id, kind, amount, balance, hold, created_at
+        FROM
+            client_event
+        WHERE
+            (tx_id, id) > ($1, $2) AND
+            tx_id < txid_snapshot_xmin(txid_current_snapshot())
+        ORDER BY
+            tx_id, id
+        LIMIT $3
+        """,
+        after_tx_id,
+        after_id,
+        limit,
+    )
+    return rows
+
+
+async def query_events_head(
+    connection: asyncpg.Connection, timeout: Optional[float] = None
+) -> Tuple[int, int]:
+    """Запрос позиции последнего события, которое уже отдаётся из ленты.
+
+    Граница та же, что в `query_events`, поэтому позиция меняется ровно тогда,
+    когда в ленте появляются новые события.
+
+    :param connection: соединение
+    :param timeout: сколько секунд ждать ответа
+    :returns: пара `(tx_id, id)`; `(0, 0)`, если лента пуста
+    """
+    row = await connection.fetchrow(
+        """
+        SELECT
+            tx_id, id
+        FROM
+            client_event
+        WHERE
+            tx_id < txid_snapshot_xmin(txid_current_snapshot())
+        ORDER BY
+            tx_id DESC, id DESC
+        LIMIT 1
+        """,
+        timeout=timeout,
+    )
+    if row is None:
+        return 0, 0
+    return row["tx_id"], row["id"]
+
+
+async def query_delete_old_events(
+    connection: asyncpg.Connection, retention: float, batch_size: int
+) -> int:
+    """Запрос на удаление событий старше `retention` секунд.
+
+    События удаляются пачками по `batch_size` штук, каждая пачка -- отдельная
+    короткая транзакция.
+
+    :param connection: соединение
+    :param retention: сколько секунд хранить события
+    :param batch_size: сколько событий удалять одной транзакцией
+    :returns: количество удалённых событий
+    """
+    deleted = 0
+    while True:
+        status: str = await connection.execute(
             """
+            DELETE FROM
+                client_event
+            WHERE
+                id IN (
+                    SELECT
+                        id
+                    FROM
+                        client_event
+                    WHERE
+                        created_at < now() - make_interval(secs => $1)
+                    LIMIT $2
+                )
+            """,
+            retention,
+            batch_size,
         )
+        # статус имеет вид `DELETE <количество строк>`
+        batch_deleted = int(status.split()[-1])
+        deleted += batch_deleted
+        if batch_deleted < batch_size:
+            return deleted
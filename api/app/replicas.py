@@ -0,0 +1,241 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+from typing import (
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+import asyncpg
+
+from app.queries import query_replay_lsn, query_wal_lsn
+
+T = TypeVar("T")
+
+# ошибки, после которых чтение с реплики повторяется на мастере: реплика
+# недоступна, зависла или отменила запрос из-за конфликта с восстановлением
+REPLICA_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.exceptions.QueryCanceledError,
+    asyncpg.exceptions.SerializationError,
+)
+# ошибки запроса позиции журнала: база недоступна, не ответила или разорвала
+# соединение
+LSN_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresError,
+    asyncpg.InterfaceError,
+)
+
+
+class Replica:
+    """Пул соединений к реплике и её последнее известное состояние."""
+
+    def __init__(self, dsn: str, pool: asyncpg.pool.Pool) -> None:
+        self.dsn = dsn
+        self.pool = pool
+        self.replay_lsn = 0
+        self.lag: Optional[float] = None
+        self.healthy = False
+
+
+class ReplicaRouter:
+    """Выбор пула для чтения: реплика, если она достаточно свежая, иначе мастер.
+
+    Отставание реплики считается относительно мастера: при каждой проверке
+    запоминается позиция журнала на мастере, и реплика отстаёт не больше, чем на
+    время, прошедшее с момента, когда мастер был в позиции, уже проигранной
+    репликой.
+
+    Для каждого клиента запоминается позиция журнала после его последней записи;
+    пока не все реплики проиграли журнал до этой позиции, чтения этого клиента
+    направляются только на догнавшие реплики или на мастер.
+    """
+
+    def __init__(
+        self,
+        primary: asyncpg.pool.Pool,
+        replicas: List[Replica],
+        max_lag: float,
+        max_tracked_writes: int,
+        query_timeout: float,
+    ) -> None:
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.max_tracked_writes = max_tracked_writes
+        self.query_timeout = query_timeout
+        self._write_lsn: Dict[str, int] = {}
+        # если клиентов с недавними записями слишком много, то вместо них
+        # запоминается одна общая позиция, до которой должна догнать реплика
+        self._floor_lsn = 0
+        # клиенты, позицию последней записи которых узнать не удалось; они читают
+        # с мастера, пока реплики не догонят позицию из следующей проверки
+        self._unknown_writes: Set[str] = set()
+        # пары (время проверки, позиция журнала на мастере), от старых к новым
+        self._primary_lsn: Deque[Tuple[float, int]] = collections.deque()
+
+    def remember_write(self, uuid: str, lsn: int) -> None:
+        """Запомнить позицию журнала после записи в счёт клиента.
+
+        :param uuid: идентификатор клиента
+        :param lsn: позиция журнала на мастере после коммита
+        """
+        self._write_lsn[uuid] = max(lsn, self._write_lsn.get(uuid, 0))
+        if len(self._write_lsn) > self.max_tracked_writes:
+            self.require_for_all(max(self._write_lsn.values()))
+            self._write_lsn.clear()
+
+    async def track_write(self, uuid: str, connection: asyncpg.Connection) -> None:
+        """Узнать позицию журнала после записи в счёт клиента и запомнить её.
+
+        Запись к этому моменту уже закоммичена, поэтому ошибка запроса позиции не
+        пробрасывается: иначе клиент получил бы ошибку и повторил бы операцию.
+        Вместо этого клиент читает с мастера до следующей проверки реплик.
+
+        :param uuid: идентификатор клиента
+        :param connection: соединение к мастеру, через которое прошла запись
+        """
+        try:
+            lsn = await query_wal_lsn(connection, self.query_timeout)
+        except LSN_ERRORS:
+            logging.exception("Could not get WAL position, reading from primary")
+            self._unknown_writes.add(uuid)
+            return
+        self.remember_write(uuid, lsn)
+
+    def require_for_all(self, lsn: int) -> None:
+        """Читать с реплики только после того, как она проиграет журнал до `lsn`.
+
+        Используется при запуске: записи, сделанные до перезапуска процесса,
+        неизвестны, поэтому реплика должна догнать текущую позицию мастера.
+
+        :param lsn: позиция журнала на мастере
+        """
+        self._floor_lsn = max(self._floor_lsn, lsn)
+
+    def choose_pool(self, uuid: str) -> asyncpg.pool.Pool:
+        """Выбрать пул, из которого можно прочитать актуальный счёт клиента.
+
+        :param uuid: идентификатор клиента
+        """
+        if uuid in self._unknown_writes:
+            return self.primary
+        required_lsn = max(self._floor_lsn, self._write_lsn.get(uuid, 0))
+        candidates = [
+            replica
+            for replica in self.replicas
+            if replica.healthy
+            and replica.lag is not None
+            and replica.lag <= self.max_lag
+            and replica.replay_lsn >= required_lsn
+        ]
+        if not candidates:
+            return self.primary
+        return random.choice(candidates).pool
+
+    def mark_failed(self, pool: asyncpg.pool.Pool) -> None:
+        """Не использовать реплику до следующей успешной проверки."""
+        for replica in self.replicas:
+            if replica.pool is pool:
+                replica.healthy = False
+
+    async def read(
+        self,
+        uuid: str,
+        query: Callable[[asyncpg.Connection, Optional[float]], Awaitable[T]],
+    ) -> T:
+        """Выполнить чтение счёта клиента на подходящей реплике или на мастере.
+
+        На реплике запрос ограничен `query_timeout` секундами; если реплика не
+        ответила или отменила запрос, то он повторяется на мастере.
+
+        :param uuid: идентификатор клиента
+        :param query: запрос, принимающий соединение и таймаут
+        """
+        pool = self.choose_pool(uuid)
+        if pool is not self.primary:
+            try:
+                async with pool.acquire(timeout=self.query_timeout) as connection:
+                    return await query(connection, self.query_timeout)
+            except REPLICA_ERRORS:
+                logging.exception("Replica is unavailable, falling back to primary")
+                self.mark_failed(pool)
+        async with self.primary.acquire() as connection:
+            return await query(connection, None)
+
+    def _lag(self, replay_lsn: int, now: float) -> Optional[float]:
+        """Оценка сверху отставания реплики в секундах; `None`, если оно неизвестно."""
+        for sampled_at, primary_lsn in reversed(self._primary_lsn):
+            if primary_lsn <= replay_lsn:
+                return now - sampled_at
+        return None
+
+    async def refresh(self) -> None:
+        """Обновить состояние реплик и забыть записи, которые уже везде видны."""
+        # эти записи закоммичены до запроса позиции ниже, поэтому она их покрывает
+        unknown_writes, self._unknown_writes = self._unknown_writes, set()
+        try:
+            async with self.primary.acquire(timeout=self.query_timeout) as connection:
+                primary_lsn = await query_wal_lsn(connection, self.query_timeout)
+        except LSN_ERRORS:
+            # без позиции мастера отставание реплик не измерить
+            logging.exception("Primary is unavailable, replicas are not used")
+            for replica in self.replicas:
+                replica.healthy = False
+            self._unknown_writes |= unknown_writes
+            return
+        for uuid in unknown_writes:
+            self.remember_write(uuid, primary_lsn)
+
+        now = time.monotonic()
+        self._primary_lsn.append((now, primary_lsn))
+        # для оценки отставания до `max_lag` достаточно одной более старой точки
+        while (
+            len(self._primary_lsn) > 1 and self._primary_lsn[1][0] < now - self.max_lag
+        ):
+            self._primary_lsn.popleft()
+
+        for number, replica in enumerate(self.replicas):
+            try:
+                async with replica.pool.acquire(timeout=self.query_timeout) as connection:
+                    replay_lsn = await query_replay_lsn(connection, self.query_timeout)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError):
+                if replica.healthy:
+                    logging.exception(f"Replica #{number} is unavailable")
+                replica.healthy = False
+                continue
+            replica.replay_lsn = replay_lsn
+            replica.lag = self._lag(replay_lsn, now)
+            replica.healthy = True
+
+        # известная позиция реплики не больше настоящей, поэтому записи до
+        # минимальной из них видны на всех репликах
+        if self.replicas:
+            caught_up_lsn = min(replica.replay_lsn for replica in self.replicas)
+            self._write_lsn = {
+                uuid: lsn
+                for uuid, lsn in self._write_lsn.items()
+                if lsn > caught_up_lsn
+            }
+            if self._floor_lsn <= caught_up_lsn:
+                self._floor_lsn = 0
+
+
+async def periodic_refresh(router: ReplicaRouter, interval: float) -> None:
+    """Проверять состояние реплик каждые `interval` секунд."""
+    while True:
+        await router.refresh()
+        await asyncio.sleep(interval)
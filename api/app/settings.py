@@ -1,3 +1,5 @@
+from typing import List
+
 from pydantic import BaseSettings
 
 
@@ -10,6 +12,22 @@ class Settings(BaseSettings):
     postgres_password = "secret"
     postgres_db = "db"
     unhold_all_interval = 600
+    client_partitions = 16
+    partition_batch_size = 10000
+    partition_swap_lock_timeout = 1.0
+    partition_swap_attempts = 10
+    # DSN реплик для чтения, например `APP_REPLICA_DSNS='["postgres://..."]'`
+    replica_dsns: List[str] = []
+    replica_max_lag = 5.0
+    replica_check_interval = 1.0
+    replica_query_timeout = 1.0
+    replica_max_tracked_writes = 100_000
+    events_poll_timeout = 25.0
+    events_check_interval = 0.2
+    events_check_timeout = 1.0
+    events_max_batch = 1000
+    events_retention = 7 * 24 * 60 * 60
+    events_delete_batch_size = 10000
 
     @property
     def pg_dsn(self) -> str:
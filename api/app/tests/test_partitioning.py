@@ -0,0 +1,329 @@
+import asyncio
+import json
+from typing import Any, Dict, List, Optional, Set
+
+import asyncpg
+import pytest
+
+from app.main import init_connection
+from app.partitioning import (
+    FIRST_ID,
+    PartitionCountMismatchError,
+    _copy_batch,
+    _install_sync_trigger,
+    _swap_tables,
+    create_partitioned_table,
+    migrate_client_table,
+)
+from app.queries import (
+    query_add,
+    query_client_partitions,
+    query_status,
+    query_subtract,
+    query_unhold_all,
+)
+from app.settings import Settings
+
+PETROV = "26c940a1-7228-4ea2-a3bc-e6460b172040"
+PARKHOMENKO = "5597cc3d-c948-48a0-b711-393edf20d9c0"
+KAZITSKY = "7badc8f8-65bc-449a-8cde-855234ac63e1"
+PETECHKIN = "867f0924-a917-4711-939b-90b179a96392"
+NEW_CLIENT = "f0000000-0000-0000-0000-000000000000"
+
+
+def scanned_relations(plan: Dict[str, Any]) -> Set[str]:
+    """Таблицы, которые читает план из `EXPLAIN (FORMAT JSON)`."""
+    relations = set()
+    if "Scan" in plan["Node Type"] and "Relation Name" in plan:
+        relations.add(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        relations |= scanned_relations(child)
+    return relations
+
+
+class ExplainingConnection:
+    """Соединение, которое вместо выполнения запросов запоминает их планы."""
+
+    def __init__(self, connection: asyncpg.Connection) -> None:
+        self.connection = connection
+        self.plans: List[Dict[str, Any]] = []
+
+    def transaction(self) -> Any:
+        return self.connection.transaction()
+
+    async def fetchrow(
+        self, query: str, *args: Any, timeout: Optional[float] = None
+    ) -> None:
+        # подготовленный оператор, чтобы `plan_cache_mode` выбирал вид плана
+        await self.connection.execute(f"PREPARE lookup AS {query}")
+        try:
+            arguments = ", ".join(f"'{arg}'" for arg in args)
+            plan = await self.connection.fetchval(
+                f"EXPLAIN (FORMAT JSON) EXECUTE lookup({arguments})"
+            )
+        finally:
+            await self.connection.execute("DEALLOCATE lookup")
+        self.plans.append(json.loads(plan)[0]["Plan"])
+
+
+@pytest.mark.asyncio
+class TestPartitioning:
+    """Тесты секционирования таблицы `client`.
+
+    Тесты меняют схему, поэтому каждый работает в своей копии основной базы.
+    """
+
+    settings = Settings()
+    database = f"{settings.postgres_db}_partitioning_test"
+
+    @pytest.fixture()
+    async def connection(self) -> asyncpg.Connection:
+        """Фикстура, возвращающая соединение к свежей копии базы с тестовыми данными."""
+        admin = await asyncpg.connect(dsn=self.settings.pg_dsn)
+        try:
+            await admin.execute(f"DROP DATABASE IF EXISTS {self.database}")
+            await admin.execute(
+                """
+                SELECT
+                    pg_terminate_backend(pg_stat_activity.pid)
+                FROM
+                    pg_stat_activity
+                WHERE
+                    pg_stat_activity.datname = $1 AND
+                    pid <> pg_backend_pid();
+                """,
+                self.settings.postgres_db,
+            )
+            await admin.execute(
+                f"""
+                CREATE DATABASE {self.database}
+                WITH TEMPLATE {self.settings.postgres_db}
+                """
+            )
+        finally:
+            await admin.close()
+
+        connection = await asyncpg.connect(
+            dsn=self.settings.pg_dsn, database=self.database
+        )
+        try:
+            await init_connection(connection)
+            await connection.execute("TRUNCATE client, client_event")
+            await connection.execute(
+                """
+                INSERT INTO client
+                       (id, name, balance, hold, is_open)
+                VALUES
+                       ($1, 'Петров Иван Сергеевич', 1700, 300, TRUE),
+                       ($2, 'Kazitsky Jason', 200, 200, TRUE),
+                       ($3, 'Пархоменко Антон Александрович', 10, 300, TRUE),
+                       ($4, 'Петечкин Петр Измаилович', 1000000, 1, FALSE)
+                """,
+                PETROV,
+                KAZITSKY,
+                PARKHOMENKO,
+                PETECHKIN,
+            )
+            yield connection
+        finally:
+            await connection.close()
+
+    @pytest.fixture()
+    async def other_connection(self, connection) -> asyncpg.Connection:
+        """Фикстура, возвращающая второе соединение к той же базе."""
+        other_connection = await asyncpg.connect(
+            dsn=self.settings.pg_dsn, database=self.database
+        )
+        try:
+            await init_connection(other_connection)
+            yield other_connection
+        finally:
+            await other_connection.close()
+
+    async def test_migrate(self, connection: asyncpg.Connection) -> None:
+        """Проверить перенос таблицы `client` в секционированную.
+
+        :param connection: соединение к базе
+        """
+        assert await query_client_partitions(connection) == ["client"]
+
+        # пачки меньше количества строк, чтобы копирование шло в несколько заходов
+        await migrate_client_table(connection, partitions=4, batch_size=3)
+        assert await query_client_partitions(connection) == [
+            "client_p0",
+            "client_p1",
+            "client_p2",
+            "client_p3",
+        ]
+
+        # повторный запуск ничего не делает
+        await migrate_client_table(connection, partitions=4, batch_size=3)
+
+        # временные имена индексов не остались, так что их можно занять снова
+        indexes = await connection.fetch(
+            """
+            SELECT
+                indexname
+            FROM
+                pg_indexes
+            WHERE
+                tablename LIKE 'client%' AND tablename <> 'client_event'
+            """
+        )
+        assert {row["indexname"] for row in indexes} == {
+            "client_pkey",
+            "client_p0_pkey",
+            "client_p1_pkey",
+            "client_p2_pkey",
+            "client_p3_pkey",
+            "client_old_pkey",
+        }
+        await create_partitioned_table(connection, "client_new", 4)
+        await connection.execute("DROP TABLE client_new")
+
+        # данные перенесены без изменений
+        client_status = await query_status(connection, PETROV)
+        assert client_status["name"] == "Петров Иван Сергеевич"
+        assert client_status["balance"] == 1700
+        assert client_status["hold"] == 300
+        assert client_status["is_open"] is True
+
+        # снятие холдов проходит по всем секциям
+        await query_unhold_all(connection)
+        expected_balance = {
+            PETROV: 1400,
+            KAZITSKY: 0,
+            PARKHOMENKO: -290,
+            PETECHKIN: 999_999,
+        }
+        for uuid, balance in expected_balance.items():
+            client_status = await query_status(connection, uuid)
+            assert client_status["balance"] == balance
+            assert client_status["hold"] == 0
+
+    async def test_resume_with_other_partitions(
+        self, connection: asyncpg.Connection
+    ) -> None:
+        """Проверить перезапуск миграции после сбоя с другим количеством секций.
+
+        :param connection: соединение к базе
+        """
+        # миграция прервалась после создания `client_new` и триггера
+        await create_partitioned_table(connection, "client_new", 4)
+        await _install_sync_trigger(connection)
+
+        with pytest.raises(PartitionCountMismatchError):
+            await migrate_client_table(connection, partitions=8, batch_size=3)
+        assert await query_client_partitions(connection) == ["client"]
+
+        await migrate_client_table(connection, partitions=4, batch_size=3)
+        assert len(await query_client_partitions(connection)) == 4
+
+    async def test_writes_during_copy(
+        self, connection: asyncpg.Connection, other_connection: asyncpg.Connection
+    ) -> None:
+        """Проверить, что записи во время копирования попадают в новую таблицу.
+
+        :param connection: соединение к базе
+        :param other_connection: второе соединение, имитирующее API
+        """
+        await create_partitioned_table(connection, "client_new", 4)
+        await _install_sync_trigger(connection)
+
+        # запись до начала копирования
+        await query_add(other_connection, PETROV, 100)
+
+        # первая пачка из одной строки: это Петров, у него самый маленький `id`
+        last_id = await _copy_batch(connection, FIRST_ID, 1)
+        assert last_id == PETROV
+
+        # изменения уже скопированной и ещё не скопированной строк, новый клиент
+        await query_subtract(other_connection, PETROV, 300)
+        await query_add(other_connection, KAZITSKY, 50)
+        await other_connection.execute(
+            """
+            INSERT INTO client
+                   (id, name, balance, hold, is_open)
+            VALUES
+                   ($1, 'Новый Клиент', 5, 0, TRUE)
+            """,
+            NEW_CLIENT,
+        )
+
+        # пока строка изменяется незавершённой транзакцией, пачка её ждёт
+        transaction = other_connection.transaction()
+        await transaction.start()
+        await query_add(other_connection, PARKHOMENKO, 1000)
+        copy = asyncio.ensure_future(_copy_batch(connection, last_id, 10))
+        await asyncio.sleep(0.5)
+        assert not copy.done()
+        await transaction.commit()
+        last_id = await copy
+
+        while last_id is not None:
+            last_id = await _copy_batch(connection, last_id, 10)
+        await _swap_tables(connection, 4, lock_timeout=1, attempts=1)
+
+        expected = {
+            PETROV: (1800, 600),
+            KAZITSKY: (250, 200),
+            PARKHOMENKO: (1010, 300),
+            PETECHKIN: (1_000_000, 1),
+            NEW_CLIENT: (5, 0),
+        }
+        for uuid, (balance, hold) in expected.items():
+            client_status = await query_status(connection, uuid)
+            assert (client_status["balance"], client_status["hold"]) == (balance, hold)
+
+    async def test_swap_lock_timeout(
+        self, connection: asyncpg.Connection, other_connection: asyncpg.Connection
+    ) -> None:
+        """Проверить, что подмена таблиц не ждёт блокировку бесконечно.
+
+        :param connection: соединение к базе
+        :param other_connection: второе соединение, имитирующее снятие холдов
+        """
+        await create_partitioned_table(connection, "client_new", 4)
+        await _install_sync_trigger(connection)
+        last_id: Optional[str] = FIRST_ID
+        while last_id is not None:
+            last_id = await _copy_batch(connection, last_id, 10)
+
+        transaction = other_connection.transaction()
+        await transaction.start()
+        await other_connection.execute("LOCK TABLE client IN ROW EXCLUSIVE MODE")
+        with pytest.raises(asyncpg.exceptions.LockNotAvailableError):
+            await _swap_tables(connection, 4, lock_timeout=0.1, attempts=2)
+        await transaction.rollback()
+
+        await _swap_tables(connection, 4, lock_timeout=0.1, attempts=2)
+        assert len(await query_client_partitions(connection)) == 4
+
+    @pytest.mark.parametrize(
+        "plan_cache_mode", ["force_custom_plan", "force_generic_plan"]
+    )
+    async def test_lookups_use_one_partition(
+        self, connection: asyncpg.Connection, plan_cache_mode: str
+    ) -> None:
+        """Проверить, что запросы API по `id` обращаются ровно к одной секции.
+
+        :param connection: соединение к базе
+        :param plan_cache_mode: какие планы строит PostgreSQL для подготовленных
+            запросов; asyncpg может получить любые из них
+        """
+        await migrate_client_table(connection, partitions=16, batch_size=100)
+        await connection.execute(f"SET plan_cache_mode = {plan_cache_mode}")
+
+        explaining = ExplainingConnection(connection)
+        await query_add(explaining, PETROV, 100)  # type: ignore
+        await query_subtract(explaining, PETROV, 100)  # type: ignore
+        await query_status(explaining, PETROV)  # type: ignore
+
+        assert len(explaining.plans) == 3
+        for plan in explaining.plans:
+            partitions = {
+                relation
+                for relation in scanned_relations(plan)
+                if relation.startswith("client_p")
+            }
+            assert len(partitions) == 1, plan
@@ -5,8 +5,11 @@ from typing import Callable, Any
 import asyncpg
 import pytest
 
+from app.events import EventNotifier
 from app.main import init_connection
 from app.queries import (
+    query_delete_old_events,
+    query_events,
     query_status,
     query_add,
     query_subtract,
@@ -74,8 +77,8 @@ class TestServerQueries:
 
     @pytest.fixture()
     async def test_data(self, connection) -> None:
-        """Очистить таблицу `client` и наполнить её заново тестовыми данными."""
-        await connection.execute("TRUNCATE client")
+        """Очистить таблицы `client`, `client_event` и наполнить `client` заново."""
+        await connection.execute("TRUNCATE client, client_event")
         await connection.execute(
             """
             INSERT INTO client
@@ -258,3 +261,173 @@ class TestServerQueries:
             client_status = await query_status(connection, uuid)
             assert client_status["balance"] == balance
             assert client_status["hold"] == 0
+
+    async def test_events(self, test_data, connection: asyncpg.Connection) -> None:
+        """Проверить, что изменения балансов попадают в ленту событий.
+
+        :param test_data: добавить тестовые данные в таблицу
+        :param connection: соединение к базе
+        """
+        uuid = "26c940a1-7228-4ea2-a3bc-e6460b172040"
+        await query_add(connection, uuid, 1000)
+        # пустые операции и неудачные списания событий не создают
+        await query_add(connection, uuid, 0)
+        await query_subtract(connection, uuid, -100)
+        with pytest.raises(NotEnoughMoneyError):
+            await query_subtract(connection, uuid, 100_000)
+        await query_subtract(connection, uuid, 100)
+        await query_unhold_all(connection)
+
+        events = await query_events(connection, 0, 0, 100)
+        client_events = [
+            (event["kind"], event["amount"], event["balance"], event["hold"])
+            for event in events
+            if event["client_id"] == uuid
+        ]
+        assert client_events == [
+            ("add", 1000, 2700, 300),
+            ("subtract", 100, 2700, 400),
+            ("unhold", 400, 2300, 0),
+        ]
+        # холд снят у всех клиентов, у которых он был
+        assert sum(event["kind"] == "unhold" for event in events) == 4
+
+        # чтение продолжается с позиции последнего прочитанного события
+        first, *rest = events
+        assert await query_events(connection, first["tx_id"], first["id"], 100) == rest
+        last = events[-1]
+        assert await query_events(connection, last["tx_id"], last["id"], 100) == []
+
+    async def test_events_watermark(
+        self, test_data, connection: asyncpg.Connection
+    ) -> None:
+        """Проверить, что лента не отдаёт события, пока идёт более старая транзакция.
+
+        Граница общая для всего кластера, поэтому ленту задерживает любая
+        незавершённая транзакция, даже не трогающая `client_event`.
+
+        :param test_data: добавить тестовые данные в таблицу
+        :param connection: соединение к базе
+        """
+        uuid = "26c940a1-7228-4ea2-a3bc-e6460b172040"
+        blocker = await asyncpg.connect(dsn=self.settings.pg_dsn)
+        try:
+            transaction = blocker.transaction()
+            await transaction.start()
+            await blocker.fetchval("SELECT txid_current()")
+
+            await query_add(connection, uuid, 1000)
+            assert await query_events(connection, 0, 0, 100) == []
+
+            await transaction.rollback()
+            events = await query_events(connection, 0, 0, 100)
+            assert [(event["kind"], event["amount"]) for event in events] == [
+                ("add", 1000)
+            ]
+        finally:
+            await blocker.close()
+
+    async def test_events_check(
+        self, test_data, connection: asyncpg.Connection
+    ) -> None:
+        """Проверить, что ожидающих будят только новые события в ленте.
+
+        :param test_data: добавить тестовые данные в таблицу
+        :param connection: соединение к базе
+        """
+        uuid = "26c940a1-7228-4ea2-a3bc-e6460b172040"
+        pool = await asyncpg.create_pool(dsn=self.settings.pg_test_dsn, min_size=1)
+        notifier = EventNotifier(pool, interval=0.05, timeout=1)
+        try:
+            await notifier.check()
+            wakeup = notifier.waiter()
+
+            # неудачное списание и закрытый счёт событий не создают
+            with pytest.raises(NotEnoughMoneyError):
+                await query_subtract(connection, uuid, 100_000)
+            await query_add(connection, "867f0924-a917-4711-939b-90b179a96392", 100)
+            await notifier.check()
+            assert not wakeup.is_set()
+
+            # событие за границей ленты тоже никого не будит
+            blocker = await asyncpg.connect(dsn=self.settings.pg_dsn)
+            try:
+                transaction = blocker.transaction()
+                await transaction.start()
+                await blocker.fetchval("SELECT txid_current()")
+                await query_subtract(connection, uuid, 100)
+                await notifier.check()
+                assert not wakeup.is_set()
+                await transaction.rollback()
+            finally:
+                await blocker.close()
+
+            await notifier.check()
+            assert wakeup.is_set()
+            assert not notifier.waiter().is_set()
+        finally:
+            await pool.close()
+
+    async def test_events_notifier_reconnects(
+        self, test_data, connection: asyncpg.Connection
+    ) -> None:
+        """Проверить, что после обрыва соединений ожидающих снова будят.
+
+        :param test_data: добавить тестовые данные в таблицу
+        :param connection: соединение к базе
+        """
+        uuid = "26c940a1-7228-4ea2-a3bc-e6460b172040"
+        pool = await asyncpg.create_pool(dsn=self.settings.pg_test_dsn, min_size=1)
+        notifier = EventNotifier(pool, interval=0.05, timeout=1)
+        notifier.start()
+        try:
+            # первая проверка будит всегда
+            assert await notifier.wait(notifier.waiter(), 5)
+
+            # без новых событий ожидание заканчивается по таймауту
+            assert not await notifier.wait(notifier.waiter(), 0.3)
+
+            # как при перезапуске PostgreSQL: все соединения пула разорваны
+            await connection.execute(
+                """
+                SELECT
+                    pg_terminate_backend(pid)
+                FROM
+                    pg_stat_activity
+                WHERE
+                    datname = current_database() AND
+                    pid <> pg_backend_pid()
+                """
+            )
+            wakeup = notifier.waiter()
+            waiting = asyncio.ensure_future(notifier.wait(wakeup, 5))
+            await asyncio.sleep(0.3)
+            await query_subtract(connection, uuid, 100)
+            assert await waiting
+        finally:
+            await notifier.close()
+            await pool.close()
+
+    async def test_delete_old_events(
+        self, test_data, connection: asyncpg.Connection
+    ) -> None:
+        """Проверить, что старые события удаляются пачками, а новые остаются.
+
+        :param test_data: добавить тестовые данные в таблицу
+        :param connection: соединение к базе
+        """
+        uuid = "26c940a1-7228-4ea2-a3bc-e6460b172040"
+        for _ in range(3):
+            await query_add(connection, uuid, 100)
+        await connection.execute(
+            """
+            UPDATE client_event
+            SET created_at = now() - interval '2 days'
+            WHERE id IN (SELECT id FROM client_event ORDER BY id LIMIT 2)
+            """
+        )
+
+        day = 24 * 60 * 60
+        assert await query_delete_old_events(connection, day, batch_size=1) == 2
+        assert len(await query_events(connection, 0, 0, 100)) == 1
+        assert await query_delete_old_events(connection, day, batch_size=1) == 0
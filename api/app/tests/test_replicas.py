@@ -0,0 +1,267 @@
+import asyncio
+from typing import Any, List, Optional
+
+import asyncpg
+import pytest
+
+from app.replicas import Replica, ReplicaRouter
+
+
+class FakeConnection:
+    """Соединение, которое на любой запрос возвращает заданное значение."""
+
+    def __init__(self, pool: "FakePool") -> None:
+        self.pool = pool
+
+    async def fetchval(self, *args: Any, timeout: Optional[float] = None) -> Any:
+        if self.pool.hang:
+            # так ведёт себя asyncpg, если сервер не ответил за `timeout` секунд
+            assert timeout is not None, "Запрос без таймаута завис бы навсегда"
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError
+        if self.pool.error is not None:
+            raise self.pool.error
+        return self.pool.value
+
+
+class FakePool:
+    """Пул, выдающий соединение к фейковой базе или падающий при подключении."""
+
+    def __init__(
+        self,
+        value: Any = None,
+        error: Optional[Exception] = None,
+        hang: bool = False,
+        refuse: bool = False,
+    ) -> None:
+        self.value = value
+        self.error = error
+        self.hang = hang
+        self.refuse = refuse
+
+    def acquire(self, **kwargs: Any) -> "FakePool":
+        return self
+
+    async def __aenter__(self) -> FakeConnection:
+        if self.refuse:
+            raise ConnectionRefusedError
+        return FakeConnection(self)
+
+    async def __aexit__(self, *args: Any) -> None:
+        pass
+
+
+def make_replica(replay_lsn: int, lag: float = 0.0) -> Replica:
+    """Исправная реплика с заданным состоянием."""
+    replica = Replica("postgres://replica", FakePool(replay_lsn))
+    replica.replay_lsn = replay_lsn
+    replica.lag = lag
+    replica.healthy = True
+    return replica
+
+
+def make_router(
+    primary: FakePool, replicas: List[Replica], max_tracked_writes: int = 10
+) -> ReplicaRouter:
+    """Роутер с допустимым отставанием в 1 секунду."""
+    return ReplicaRouter(
+        primary,
+        replicas,
+        max_lag=1,
+        max_tracked_writes=max_tracked_writes,
+        query_timeout=0.1,
+    )
+
+
+@pytest.mark.asyncio
+class TestReplicaRouter:
+    """Тесты выбора пула для чтения."""
+
+    async def test_without_replicas(self) -> None:
+        """Без реплик всё читается с мастера."""
+        primary = FakePool()
+        router = make_router(primary, [])
+        assert router.choose_pool("a") is primary
+
+    async def test_lag(self) -> None:
+        """Отстающие и недоступные реплики не используются."""
+        primary = FakePool()
+        lagging = make_replica(100, lag=10)
+        broken = make_replica(100)
+        broken.healthy = False
+        router = make_router(primary, [lagging, broken])
+        assert router.choose_pool("a") is primary
+
+        fresh = make_replica(100)
+        router.replicas.append(fresh)
+        assert router.choose_pool("a") is fresh.pool
+
+        router.mark_failed(fresh.pool)
+        assert router.choose_pool("a") is primary
+
+    async def test_read_your_writes(self) -> None:
+        """После записи клиент читает только с догнавшей реплики или с мастера."""
+        primary = FakePool()
+        behind = make_replica(100)
+        router = make_router(primary, [behind])
+        router.remember_write("a", 200)
+        assert router.choose_pool("a") is primary
+        # на других клиентов запись не влияет
+        assert router.choose_pool("b") is behind.pool
+
+        ahead = make_replica(200)
+        router.replicas.append(ahead)
+        assert router.choose_pool("a") is ahead.pool
+
+    async def test_track_write_without_lsn(self) -> None:
+        """Если позицию после записи узнать не удалось, то клиент читает с мастера."""
+        primary = FakePool(300)
+        replica = make_replica(300)
+        router = make_router(primary, [replica])
+
+        lost = FakePool(error=asyncpg.exceptions.ConnectionDoesNotExistError())
+        await router.track_write("a", FakeConnection(lost))
+        assert router.choose_pool("a") is primary
+        assert router.choose_pool("b") is replica.pool
+
+        # следующая проверка берёт позицию мастера, которую реплика ещё не догнала
+        primary.value = 400
+        await router.refresh()
+        assert router.choose_pool("a") is primary
+
+        replica.pool.value = 400
+        await router.refresh()
+        assert router.choose_pool("a") is replica.pool
+
+    async def test_require_for_all(self) -> None:
+        """После перезапуска реплика должна догнать позицию мастера при запуске."""
+        primary = FakePool(300)
+        replica = make_replica(100)
+        router = make_router(primary, [replica])
+        router.require_for_all(200)
+        assert router.choose_pool("a") is primary
+
+        # реплика догнала мастер -- ограничение снимается
+        replica.pool.value = 300
+        await router.refresh()
+        assert router.choose_pool("a") is replica.pool
+
+    async def test_refresh(self) -> None:
+        """Проверка реплик обновляет их состояние и забывает догнанные записи."""
+        primary = FakePool(300)
+        replica = Replica("postgres://replica", FakePool(300))
+        broken = Replica("postgres://broken", FakePool(refuse=True))
+        router = make_router(primary, [replica, broken])
+        router.remember_write("a", 200)
+
+        await router.refresh()
+        assert replica.healthy and replica.replay_lsn == 300 and replica.lag == 0
+        assert not broken.healthy
+        assert router.choose_pool("a") is replica.pool
+
+        # сломанная реплика могла не догнать запись, поэтому запись не забыта
+        stale = make_replica(0)
+        router.replicas = [stale]
+        assert router.choose_pool("a") is primary
+
+        # когда запись видна на всех репликах, её можно забыть
+        router.replicas = [replica]
+        await router.refresh()
+        router.replicas = [stale]
+        assert router.choose_pool("a") is stale.pool
+
+    async def test_disconnected_replica_lag(self, monkeypatch) -> None:
+        """Реплика, переставшая получать журнал, считается отстающей.
+
+        Сама она в этом состоянии проиграла всё полученное и не видит отставания,
+        поэтому оно считается по позиции мастера.
+        """
+        now = 1000.0
+        monkeypatch.setattr("app.replicas.time.monotonic", lambda: now)
+        primary = FakePool(100)
+        replica = Replica("postgres://replica", FakePool(100))
+        router = make_router(primary, [replica])
+
+        await router.refresh()
+        assert replica.lag == 0
+        assert router.choose_pool("a") is replica.pool
+
+        # мастер уходит вперёд, а реплика стоит на месте
+        for lsn in (200, 300, 400):
+            now += 0.6
+            primary.value = lsn
+            await router.refresh()
+        # реплика доступна, но её позиция старше всех точек за последнюю секунду
+        assert replica.healthy
+        assert replica.lag is None or replica.lag > 1
+        assert router.choose_pool("a") is primary
+
+        # реплика догнала мастер
+        replica.pool.value = 400
+        await router.refresh()
+        assert replica.lag == 0
+        assert router.choose_pool("a") is replica.pool
+
+    async def test_refresh_hanging_replica(self) -> None:
+        """Зависшая реплика не останавливает проверку и перестаёт использоваться."""
+        primary = FakePool(100)
+        replica = Replica("postgres://replica", FakePool(100))
+        router = make_router(primary, [replica])
+        await router.refresh()
+        assert replica.healthy
+
+        replica.pool.hang = True
+        await asyncio.wait_for(router.refresh(), timeout=1)
+        assert not replica.healthy
+        assert router.choose_pool("a") is primary
+
+    @pytest.mark.parametrize(
+        "replica_pool",
+        [
+            FakePool(refuse=True),
+            FakePool(hang=True),
+            FakePool(error=asyncpg.exceptions.QueryCanceledError("recovery conflict")),
+            FakePool(error=asyncpg.exceptions.SerializationError("recovery conflict")),
+        ],
+    )
+    async def test_read_fallback(self, replica_pool: FakePool) -> None:
+        """Если реплика не смогла ответить, то чтение повторяется на мастере."""
+        primary = FakePool("primary")
+        replica = make_replica(100)
+        replica.pool = replica_pool
+        router = make_router(primary, [replica])
+
+        def query(connection: FakeConnection, timeout: Optional[float]) -> Any:
+            return connection.fetchval(timeout=timeout)
+
+        result = await asyncio.wait_for(router.read("a", query), timeout=1)
+        assert result == "primary"
+        assert not replica.healthy
+
+    async def test_read_from_replica(self) -> None:
+        """Чтение с исправной реплики ограничено таймаутом, а с мастера -- нет."""
+        timeouts = []
+
+        async def query(connection: FakeConnection, timeout: Optional[float]) -> Any:
+            timeouts.append(timeout)
+            return await connection.fetchval()
+
+        primary = FakePool("primary")
+        replica = make_replica(100)
+        replica.pool.value = "replica"
+        router = make_router(primary, [replica])
+        assert await router.read("a", query) == "replica"
+
+        router.remember_write("a", 200)
+        assert await router.read("a", query) == "primary"
+        assert timeouts == [0.1, None]
+
+    async def test_max_tracked_writes(self) -> None:
+        """При переполнении все реплики должны догнать самую свежую запись."""
+        primary = FakePool()
+        replica = make_replica(150)
+        router = make_router(primary, [replica], max_tracked_writes=2)
+        router.remember_write("a", 100)
+        router.remember_write("b", 200)
+        router.remember_write("c", 120)
+        assert router.choose_pool("d") is primary
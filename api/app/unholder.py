@@ -4,11 +4,14 @@ import logging
 import asyncpg
 
 from app.settings import Settings
-from app.queries import query_unhold_all
+from app.queries import query_unhold_all, query_delete_old_events
 
 
 async def periodic_unhold_all() -> None:
-    """Обнулять холд и обновлять баланс клиентов каждые `unhold_all_interval` секунд."""
+    """Обнулять холд и обновлять баланс клиентов каждые `unhold_all_interval` секунд.
+
+    Заодно удаляются события старше `events_retention` секунд.
+    """
     logging.info("Starting...")
     settings = Settings()
     connection = await asyncpg.connect(dsn=settings.pg_dsn)
@@ -16,3 +19,8 @@ async def periodic_unhold_all() -> None:
         await asyncio.sleep(settings.unhold_all_interval)
         logging.info("Subtracting holds from balances...")
         await query_unhold_all(connection)
+        logging.info("Deleting old events...")
+        deleted = await query_delete_old_events(
+            connection, settings.events_retention, settings.events_delete_batch_size
+        )
+        logging.info(f"Deleted {deleted} events")
@@ -0,0 +1,172 @@
+"""Бенчмарк обычной и секционированной по хэшу таблицы `client`.
+
+Запуск (из каталога `api`, нужен доступный Postgres из настроек):
+
+    python -m benchmarks.partitioning 1000000 10000000 50000000
+
+Для каждого размера таблица создаётся заново в отдельной базе `<db>_bench`.
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import statistics
+import time
+import uuid
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List
+
+import asyncpg
+
+from app.partitioning import migrate_client_table
+from app.queries import query_status, query_subtract, query_unhold_all
+from app.settings import Settings
+
+FILL_CHUNK = 1_000_000
+# каталог `sql` репозитория; в контейнере `api` он смонтирован в `/sql`
+SQL_DIR = Path(__file__).resolve().parents[2] / "sql"
+
+
+def client_id(number: int) -> str:
+    """Идентификатор клиента с номером `number`, такой же, как при заполнении."""
+    return str(uuid.UUID(hashlib.md5(str(number).encode()).hexdigest()))
+
+
+async def create_schema(connection: asyncpg.Connection, partitions: int) -> None:
+    """Создать таблицы из `sql/*-create-*.sql`, как это делает `03-create-tables.sh`.
+
+    Файлы с тестовыми строками не выполняются. Если `partitions` не ноль, то
+    `client` секционируется той же миграцией, что и в боевой базе.
+    """
+    for path in sorted(SQL_DIR.glob("*-create-*.sql")):
+        await connection.execute(path.read_text())
+    if partitions:
+        await migrate_client_table(connection, partitions, batch_size=FILL_CHUNK)
+        await connection.execute("DROP TABLE client_old")
+
+
+async def recreate_database(settings: Settings, name: str) -> None:
+    """Пересоздать пустую базу для бенчмарка."""
+    connection = await asyncpg.connect(dsn=settings.pg_dsn)
+    try:
+        await connection.execute(f"DROP DATABASE IF EXISTS {name}")
+        await connection.execute(f"CREATE DATABASE {name}")
+    finally:
+        await connection.close()
+
+
+async def fill_table(connection: asyncpg.Connection, rows: int) -> None:
+    """Наполнить `client` строками; у каждого десятого клиента есть холд."""
+    for start in range(0, rows, FILL_CHUNK):
+        await connection.execute(
+            """
+            INSERT INTO client
+                   (id, name, balance, hold, is_open)
+            SELECT
+                   md5(i::text)::uuid,
+                   'client ' || i,
+                   100000,
+                   CASE WHEN i % 10 = 0 THEN 100 ELSE 0 END,
+                   TRUE
+            FROM
+                   generate_series($1::bigint, $2::bigint) AS i
+            """,
+            start,
+            min(start + FILL_CHUNK, rows) - 1,
+        )
+    await connection.execute("VACUUM ANALYZE client")
+
+
+async def measure_latency(
+    function: Callable[[str], Awaitable], rows: int, samples: int
+) -> Dict[str, float]:
+    """Вызвать `function` для случайных клиентов и вернуть p50/p99 в миллисекундах."""
+    timings: List[float] = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        await function(client_id(random.randrange(rows)))
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "p50": statistics.median(timings),
+        "p99": timings[int(len(timings) * 0.99) - 1],
+    }
+
+
+async def run_case(
+    settings: Settings, rows: int, partitions: int, samples: int
+) -> Dict[str, float]:
+    """Прогнать один вариант: `partitions == 0` означает обычную таблицу."""
+    database = f"{settings.postgres_db}_bench"
+    await recreate_database(settings, database)
+    connection = await asyncpg.connect(dsn=settings.pg_dsn, database=database)
+    try:
+        await create_schema(connection, partitions)
+
+        started = time.perf_counter()
+        await fill_table(connection, rows)
+        fill_seconds = time.perf_counter() - started
+
+        status = await measure_latency(
+            lambda client: query_status(connection, client), rows, samples
+        )
+        subtract = await measure_latency(
+            lambda client: query_subtract(connection, client, 1), rows, samples
+        )
+
+        started = time.perf_counter()
+        await query_unhold_all(connection)
+        unhold_seconds = time.perf_counter() - started
+
+        size = await connection.fetchval(
+            """
+            SELECT
+                COALESCE(SUM(pg_total_relation_size(inhrelid)), 0)::bigint
+                + pg_total_relation_size('client')
+            FROM
+                pg_inherits
+            WHERE
+                inhparent = 'client'::regclass
+            """
+        )
+    finally:
+        await connection.close()
+
+    return {
+        "fill_s": fill_seconds,
+        "status_p50_ms": status["p50"],
+        "status_p99_ms": status["p99"],
+        "subtract_p50_ms": subtract["p50"],
+        "subtract_p99_ms": subtract["p99"],
+        "unhold_s": unhold_seconds,
+        "size_mb": size / 2 ** 20,
+    }
+
+
+async def main(sizes: List[int], partitions: int, samples: int) -> None:
+    settings = Settings()
+    columns = None
+    for rows in sizes:
+        for layout_partitions in (0, partitions):
+            result = await run_case(settings, rows, layout_partitions, samples)
+            if columns is None:
+                columns = list(result)
+                header = (column.rjust(16) for column in columns)
+                print("rows".rjust(10), "layout".rjust(8), *header)
+            layout = f"hash/{layout_partitions}" if layout_partitions else "plain"
+            print(
+                str(rows).rjust(10),
+                layout.rjust(8),
+                *(f"{result[c]:.3f}".rjust(16) for c in columns),
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "sizes", type=int, nargs="*", default=[1_000_000, 10_000_000, 50_000_000]
+    )
+    parser.add_argument("--partitions", type=int, default=Settings().client_partitions)
+    parser.add_argument("--samples", type=int, default=10_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.partitions, args.samples))
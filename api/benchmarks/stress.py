@@ -0,0 +1,300 @@
+"""Нагрузочный тест конкурентных пополнений и списаний при работающем `unholder`.
+
+Запуск (из каталога `api`, нужен доступный Postgres из настроек):
+
+    python -m benchmarks.stress --clients 100 --operations 20000 --concurrency 50
+
+Тест создаёт отдельную базу `<db>_stress`, параллельно выполняет `query_add` и
+`query_subtract` по небольшому набору клиентов (чтобы запросы конкурировали за
+строки), пока отдельное соединение в цикле вызывает `query_unhold_all`.
+После этого проверяются инварианты:
+
+* ни у одного клиента доступный баланс (`balance - hold`) не отрицательный --
+  ни в конце, ни после какой-либо операции: каждое событие в `client_event`
+  хранит баланс и холд сразу после неё;
+* сумма денег сохраняется: начальная сумма + пополнения - списания;
+* лента событий содержит ровно успешные операции и снятия холдов.
+
+Если инвариант нарушен, то процесс завершается с кодом 1.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+import asyncpg
+
+from app.main import init_connection
+from app.queries import NotEnoughMoneyError, query_add, query_subtract, query_unhold_all
+from app.settings import Settings
+from benchmarks.partitioning import client_id, create_schema, recreate_database
+
+RETRIABLE_ERRORS = (
+    asyncpg.exceptions.DeadlockDetectedError,
+    asyncpg.exceptions.SerializationError,
+)
+MAX_ATTEMPTS = 5
+LOCK_SAMPLE_INTERVAL = 0.01
+
+
+class Stats:
+    """Счётчики, которые собирают воркеры."""
+
+    def __init__(self) -> None:
+        self.added = 0
+        self.subtracted = 0
+        self.rejected = 0
+        self.retries = 0
+        self.deadlocks = 0
+        self.failures = 0
+        self.sweeps = 0
+        self.lock_wait = 0.0
+        self.latencies: List[float] = []
+
+
+async def prepare(connection: asyncpg.Connection, clients: int, partitions: int) -> int:
+    """Создать таблицы и клиентов с одинаковым балансом.
+
+    :returns: начальная сумма денег на всех счетах
+    """
+    await create_schema(connection, partitions)
+    await connection.execute(
+        """
+        INSERT INTO client
+               (id, name, balance, hold, is_open)
+        SELECT
+               md5(i::text)::uuid, 'client ' || i, 10000, 0, TRUE
+        FROM
+               generate_series(0, $1 - 1) AS i
+        """,
+        clients,
+    )
+    total: int = await connection.fetchval("SELECT SUM(balance)::bigint FROM client")
+    return total
+
+
+async def worker(
+    pool: asyncpg.pool.Pool, queue: "asyncio.Queue[int]", clients: int, stats: Stats
+) -> None:
+    """Выполнять случайные пополнения и списания, пока не опустеет очередь."""
+    while not queue.empty():
+        queue.get_nowait()
+        uuid = client_id(random.randrange(clients))
+        how_much = random.randint(1, 500)
+        is_add = random.random() < 0.5
+        started = time.perf_counter()
+        for _ in range(MAX_ATTEMPTS):
+            try:
+                async with pool.acquire() as connection:
+                    if is_add:
+                        await query_add(connection, uuid, how_much)
+                        stats.added += how_much
+                    else:
+                        await query_subtract(connection, uuid, how_much)
+                        stats.subtracted += how_much
+                break
+            except NotEnoughMoneyError:
+                stats.rejected += 1
+                break
+            except RETRIABLE_ERRORS as exc:
+                if isinstance(exc, asyncpg.exceptions.DeadlockDetectedError):
+                    stats.deadlocks += 1
+                stats.retries += 1
+        else:
+            stats.failures += 1
+        stats.latencies.append(time.perf_counter() - started)
+
+
+async def unholder(
+    dsn: str, database: str, interval: float, stop: asyncio.Event, stats: Stats
+) -> None:
+    """Снимать холды в цикле, как это делает `unholder`, пока не выставлен `stop`."""
+    connection = await asyncpg.connect(dsn=dsn, database=database)
+    try:
+        while not stop.is_set():
+            try:
+                await query_unhold_all(connection)
+                stats.sweeps += 1
+            except RETRIABLE_ERRORS as exc:
+                if isinstance(exc, asyncpg.exceptions.DeadlockDetectedError):
+                    stats.deadlocks += 1
+                stats.retries += 1
+            await asyncio.sleep(interval)
+    finally:
+        await connection.close()
+
+
+async def lock_sampler(
+    dsn: str, database: str, stop: asyncio.Event, stats: Stats
+) -> None:
+    """Оценить суммарное время ожидания блокировок по выборкам `pg_stat_activity`.
+
+    Каждая выборка считается длящейся до следующей: между ними проходит не
+    `LOCK_SAMPLE_INTERVAL`, а больше -- ещё и время самого запроса и ожидания
+    цикла событий под нагрузкой, поэтому используется измеренный интервал.
+    """
+    connection = await asyncpg.connect(dsn=dsn, database=database)
+    try:
+        sampled_at = time.perf_counter()
+        while not stop.is_set():
+            waiting = await connection.fetchval(
+                """
+                SELECT
+                    count(*)
+                FROM
+                    pg_stat_activity
+                WHERE
+                    datname = current_database() AND
+                    wait_event_type = 'Lock'
+                """
+            )
+            now = time.perf_counter()
+            stats.lock_wait += waiting * (now - sampled_at)
+            sampled_at = now
+            await asyncio.sleep(LOCK_SAMPLE_INTERVAL)
+    finally:
+        await connection.close()
+
+
+async def check_invariants(
+    connection: asyncpg.Connection, initial_total: int, stats: Stats
+) -> List[str]:
+    """Проверить инварианты после нагрузки и финального снятия холдов.
+
+    :returns: список нарушений; если нарушений нет, то список пустой
+    """
+    errors = []
+    # история, а не только итог: отрицательный баланс мог появиться и исчезнуть
+    negative = await connection.fetchval(
+        "SELECT count(*) FROM client_event WHERE balance - hold < 0"
+    )
+    if negative:
+        errors.append(f"{negative} operations left negative available balance")
+    negative = await connection.fetchval(
+        "SELECT count(*) FROM client WHERE balance - hold < 0"
+    )
+    if negative:
+        errors.append(f"{negative} clients have negative available balance")
+
+    # до финального снятия холдов деньги на счетах -- это `balance - hold`
+    available = await connection.fetchval(
+        "SELECT SUM(balance - hold)::bigint FROM client"
+    )
+    expected = initial_total + stats.added - stats.subtracted
+    if available != expected:
+        errors.append(f"Money is not conserved: expected {expected}, got {available}")
+
+    await query_unhold_all(connection)
+    balance = await connection.fetchval("SELECT SUM(balance)::bigint FROM client")
+    if balance != expected:
+        errors.append(f"Money is not conserved after unhold: {balance} != {expected}")
+    negative = await connection.fetchval(
+        "SELECT count(*) FROM client WHERE balance < 0"
+    )
+    if negative:
+        errors.append(f"{negative} clients have negative balance after unhold")
+
+    rows = await connection.fetch(
+        "SELECT kind, SUM(amount)::bigint AS amount FROM client_event GROUP BY kind"
+    )
+    events: Dict[str, int] = {row["kind"]: row["amount"] for row in rows}
+    for kind, amount in (
+        ("add", stats.added),
+        ("subtract", stats.subtracted),
+        ("unhold", stats.subtracted),
+    ):
+        if events.get(kind, 0) != amount:
+            errors.append(
+                f"Events {kind} sum up to {events.get(kind, 0)}, expected {amount}"
+            )
+    return errors
+
+
+async def main(args: argparse.Namespace) -> int:
+    settings = Settings()
+    database = f"{settings.postgres_db}_stress"
+    await recreate_database(settings, database)
+
+    connection = await asyncpg.connect(dsn=settings.pg_dsn, database=database)
+    await init_connection(connection)
+    try:
+        initial_total = await prepare(connection, args.clients, args.partitions)
+        deadlocks_before = await connection.fetchval(
+            "SELECT deadlocks FROM pg_stat_database WHERE datname = current_database()"
+        )
+
+        stats = Stats()
+        queue: "asyncio.Queue[int]" = asyncio.Queue()
+        for number in range(args.operations):
+            queue.put_nowait(number)
+        stop = asyncio.Event()
+        pool = await asyncpg.create_pool(
+            dsn=settings.pg_dsn,
+            database=database,
+            min_size=args.concurrency,
+            max_size=args.concurrency,
+            init=init_connection,
+        )
+        background = [
+            asyncio.ensure_future(
+                unholder(settings.pg_dsn, database, args.unhold_interval, stop, stats)
+            ),
+            asyncio.ensure_future(lock_sampler(settings.pg_dsn, database, stop, stats)),
+        ]
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(
+                *(
+                    worker(pool, queue, args.clients, stats)
+                    for _ in range(args.concurrency)
+                )
+            )
+        finally:
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await asyncio.gather(*background)
+            await pool.close()
+
+        # статистика Postgres обновляется с задержкой
+        await asyncio.sleep(1)
+        await connection.execute("SELECT pg_stat_clear_snapshot()")
+        server_deadlocks = (
+            await connection.fetchval(
+                "SELECT deadlocks FROM pg_stat_database "
+                "WHERE datname = current_database()"
+            )
+            - deadlocks_before
+        )
+        errors = await check_invariants(connection, initial_total, stats)
+    finally:
+        await connection.close()
+
+    latencies = sorted(stats.latencies)
+    print(f"operations:       {args.operations}")
+    print(f"elapsed, s:       {elapsed:.3f}")
+    print(f"throughput, op/s: {args.operations / elapsed:.1f}")
+    print(f"latency p50, ms:  {statistics.median(latencies) * 1000:.3f}")
+    print(f"latency p99, ms:  {latencies[int(len(latencies) * 0.99) - 1] * 1000:.3f}")
+    print(f"rejected:         {stats.rejected}")
+    print(f"retries:          {stats.retries}")
+    print(f"failures:         {stats.failures}")
+    print(f"deadlocks:        {stats.deadlocks} (server: {server_deadlocks})")
+    print(f"lock wait, s:     {stats.lock_wait:.3f}")
+    print(f"unhold sweeps:    {stats.sweeps}")
+
+    for error in errors:
+        print(f"INVARIANT VIOLATED: {error}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--operations", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--unhold-interval", type=float, default=0.05)
+    parser.add_argument("--partitions", type=int, default=0)
+    sys.exit(asyncio.run(main(parser.parse_args())))
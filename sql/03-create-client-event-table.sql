@@ -0,0 +1,12 @@
+CREATE TABLE client_event (
+       id BIGSERIAL PRIMARY KEY,
+       tx_id BIGINT NOT NULL DEFAULT txid_current(),
+       client_id UUID NOT NULL,
+       kind TEXT NOT NULL,
+       amount BIGINT NOT NULL,
+       balance BIGINT NOT NULL,
+       hold BIGINT NOT NULL,
+       created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX client_event_position_idx ON client_event (tx_id, id);
+CREATE INDEX client_event_created_at_idx ON client_event USING BRIN (created_at);